@@ -16,29 +16,48 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import asyncio
+import json
 import logging
+import os
 import sys
 import time
 from datetime import datetime, timezone
+from itertools import islice
 import types
+from concurrent.futures import ThreadPoolExecutor
 from os import path
-from typing import List
+from typing import Dict, List, Optional
 
 from web3 import Web3
 
-from pymaker import Address, web3_via_http
+from pymaker import Address, Transact, web3_via_http
 from pymaker.gas import DefaultGasPrice, FixedGasPrice
 from pymaker.auctions import Flipper, Flapper, Flopper
 from pymaker.keys import register_keys
 from pymaker.lifecycle import Lifecycle
-from pymaker.numeric import Wad, Rad, Ray
+from pymaker.numeric import Wad, Rad
 from pymaker.token import ERC20Token
+from pymaker.transactional import TxManager
 from pymaker.deployment import DssDeployment
 from pymaker.dss import Ilk, Urn
 
 from auction_keeper.urn_history import UrnHistory
 from auction_keeper.gas import DynamicGasPrice
 
+from src.gas import CachedGasPrice
+from src.urn_cache import UrnCache
+
+RAY = 10**27
+ZERO_ADDRESS = Address("0x0000000000000000000000000000000000000000")
+
+# Ilk histories scanned at once; each scan holds the ilk's full urn history in memory until it has been filtered
+MAX_CONCURRENT_SCANS = 4
+
+# Calls bundled per TxManager transaction; keeps a bundle of skims well within the block gas limit
+TX_MANAGER_BATCH_SIZE = 20
+
+
 class CageKeeper:
     """Keeper to facilitate Emergency Shutdown"""
 
@@ -80,6 +99,18 @@ class CageKeeper:
         parser.add_argument("--vulcanize-key", type=str,
                             help="API key for the Vulcanize endpoint")
 
+        parser.add_argument("--urn-cache-file", type=str,
+                            help="When specified, urns found on-chain are saved to this file, so re-running the "
+                                 "processing period only scans blocks not yet seen (e.g. /Full/Path/To/urns.json)")
+
+        parser.add_argument("--tx-manager", type=str,
+                            help="Address of a TxManager owned by --eth-from; when specified, End and auction calls "
+                                 "are bundled into TxManager transactions")
+
+        parser.add_argument("--state-file", type=str,
+                            help="When specified, cage confirmations and progress are saved to this file after each "
+                                 "block and restored on startup (e.g. /Full/Path/To/cage_keeper_state.json)")
+
         parser.add_argument("--max-errors", type=int, default=100,
                             help="Maximum number of allowed errors before the keeper terminates (default: 100)")
 
@@ -100,6 +131,9 @@ class CageKeeper:
         self.web3: Web3 = kwargs['web3'] if 'web3' in kwargs else web3_via_http(
             endpoint_uri=self.arguments.rpc_host, timeout=self.arguments.rpc_timeout, http_pool_size=100)
 
+        # Independent contract reads are issued concurrently over the pooled HTTP connections
+        self.reader = ThreadPoolExecutor(max_workers=20)
+
         self.web3.eth.defaultAccount = self.arguments.eth_from
         register_keys(self.web3, self.arguments.eth_key)
         self.our_address = Address(self.arguments.eth_from)
@@ -111,6 +145,17 @@ class CageKeeper:
 
         self.deployment_block = self.arguments.vat_deployment_block
 
+        if self.arguments.tx_manager:
+            self.tx_manager = TxManager(web3=self.web3, address=Address(self.arguments.tx_manager))
+        else:
+            self.tx_manager = None
+
+        # Urn history from Vulcanize is not block-ranged, so only on-chain queries use the urn cache
+        if self.arguments.urn_cache_file and not self.arguments.vulcanize_endpoint:
+            self.urn_cache = UrnCache(self.arguments.urn_cache_file, self.dss.vat.address, self.deployment_block)
+        else:
+            self.urn_cache = None
+
         self.max_errors = self.arguments.max_errors
         self.errors = 0
 
@@ -118,9 +163,20 @@ class CageKeeper:
 
         self.confirmations = 0
 
+        if self.arguments.state_file:
+            self.load_state()
+
+        # Confirmations are only counted once End.live() has returned 0
+        self._caged = self.confirmations > 0
+
+        # End.when is set once by End.cage() and End.wait is fixed by governance; read them once caged
+        self._cached_when = None
+        self._cached_wait = None
+
         # Create gas strategy
         if self.arguments.ethgasstation_api_key:
-            self.gas_price = DynamicGasPrice(self.arguments, self.web3)
+            # Every transaction of a batch prices itself; share one lookup between them
+            self.gas_price = CachedGasPrice(DynamicGasPrice(self.arguments, self.web3))
         else:
             self.gas_price = DefaultGasPrice()
 
@@ -141,6 +197,7 @@ class CageKeeper:
             self.lifecycle = lifecycle
             lifecycle.on_startup(self.check_deployment)
             lifecycle.on_block(self.process_block)
+            lifecycle.on_shutdown(self.shutdown)
 
 
     def check_deployment(self):
@@ -153,6 +210,8 @@ class CageKeeper:
         self.logger.info(f'Flopper: {self.dss.flopper.address}')
         self.logger.info(f'Jug: {self.dss.jug.address}')
         self.logger.info(f'End: {self.dss.end.address}')
+        if self.tx_manager:
+            self.logger.info(f'TxManager: {self.tx_manager.address}')
         self.logger.info('')
 
 
@@ -161,29 +220,49 @@ class CageKeeper:
         if self.errors >= self.max_errors:
             self.lifecycle.terminate()
         else:
-            self.check_cage()
+            # Lifecycle logs the error; count it towards --max-errors
+            try:
+                self.check_cage()
+            except Exception:
+                self.errors += 1
+                raise
+
+
+    def shutdown(self):
+        """ Stops the threads used for concurrent contract reads """
+        self.reader.shutdown(wait=True)
 
 
     def check_cage(self):
         """ After live is 0 for 12 block confirmations, facilitate the processing period, then thaw the cage """
-        blockNumber = self.web3.eth.blockNumber
+        # A single header read provides both the block number and its timestamp
+        block = self.web3.eth.getBlock('latest')
+        blockNumber = block.number
         self.logger.info(f'Checking Cage on block {blockNumber}')
 
-        live = self.dss.end.live()
+        # End.cage() cannot be undone, so once live has been read as 0 it is never read again
+        if not self._caged:
+            self._caged = not self.dss.end.live()
+        live = not self._caged
 
         # Ensure 12 blocks confirmations have passed before facilitating cage
         if not live and (self.confirmations == 12):
             self.logger.info('======== System has been caged ========')
 
-            when = self.dss.end.when()
-            wait = self.dss.end.wait()
+            if self._cached_when is None:
+                self._cached_when = self.dss.end.when()
+                self._cached_wait = self.dss.end.wait()
+
+            when = self._cached_when
+            wait = self._cached_wait
             whenInUnix = when.replace(tzinfo=timezone.utc).timestamp()
-            now = self.web3.eth.getBlock(blockNumber).timestamp
+            now = block.timestamp
             thawedCage = whenInUnix + wait
 
             if not self.cageFacilitated:
-                self.cageFacilitated = True
+                # Only marked once it completes, so a failed facilitation is retried (and never saved as done)
                 self.facilitate_processing_period()
+                self.cageFacilitated = True
 
             # wait until processing time concludes
             elif (now >= thawedCage):
@@ -202,6 +281,44 @@ class CageKeeper:
             self.confirmations = self.confirmations + 1
             self.logger.info(f'======== System has been caged ( {self.confirmations} confirmations) ========')
 
+        if self.arguments.state_file:
+            self.save_state()
+
+
+    def load_state(self):
+        """ Restores cage confirmations and progress saved by a previous run against the same End """
+        if not path.isfile(self.arguments.state_file):
+            return
+
+        try:
+            with open(self.arguments.state_file, "r") as file:
+                state = json.load(file)
+
+            if state["end"] != self.dss.end.address.address:
+                self.logger.warning(f'Ignoring {self.arguments.state_file}; it was saved for End {state["end"]}')
+                return
+
+            confirmations = int(state["confirmations"])
+            cageFacilitated = bool(state["cageFacilitated"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning(f"Ignoring unreadable state file {self.arguments.state_file}: {e}")
+            return
+
+        self.confirmations = confirmations
+        self.cageFacilitated = self.cageFacilitated or cageFacilitated
+        self.logger.info(f'Restored state: {self.confirmations} confirmations, '
+                         f'cage {"" if self.cageFacilitated else "not "}facilitated')
+
+
+    def save_state(self):
+        """ Writes the state to a temporary file first, so a crash cannot leave a partially written state file """
+        temp_file = f'{self.arguments.state_file}.tmp'
+        with open(temp_file, "w") as file:
+            json.dump({"end": self.dss.end.address.address,
+                       "confirmations": self.confirmations,
+                       "cageFacilitated": self.cageFacilitated}, file)
+        os.replace(temp_file, self.arguments.state_file)
+
 
     def facilitate_processing_period(self):
         """ Yank all active flap/flop auctions, cage all ilks, skip all flip auctions, skim all underwater urns  """
@@ -219,21 +336,23 @@ class CageKeeper:
         self.yank_auctions(auctions["flaps"], auctions["flops"])
 
         # Cage all ilks
-        for ilk in ilks:
-            self.dss.end.cage(ilk).transact(gas_price=self.gas_price)
+        self.transact_all([self.dss.end.cage(ilk) for ilk in ilks])
 
-        # Skip all flip auctions
+        # Skip all flip auctions; End.skip requires the ilk to have been caged first
+        # End.skip only needs the ilk name, which the deployment already holds; no need to read the Vat
+        ilk_by_name = {collateral.ilk.name: collateral.ilk for collateral in self.dss.collaterals.values()}
+        skips = []
         for key in auctions["flips"].keys():
-            ilk = self.dss.vat.ilk(key)
+            ilk = ilk_by_name[key]
             for bid in auctions["flips"][key]:
-                self.dss.end.skip(ilk,bid.id).transact(gas_price=self.gas_price)
+                skips.append(self.dss.end.skip(ilk,bid.id))
+        self.transact_all(skips)
 
         #get all underwater urns
         urns = self.get_underwater_urns(ilks)
 
         #skim all underwater urns
-        for i in urns:
-            self.dss.end.skim(i.ilk, i.address).transact(gas_price=self.gas_price)
+        self.transact_all([self.dss.end.skim(i.ilk, i.address) for i in urns])
 
 
     def thaw_cage(self):
@@ -253,16 +372,17 @@ class CageKeeper:
         self.dss.end.thaw().transact(gas_price=self.gas_price)
 
         # Set fix (collateral/Dai ratio) for all Ilks
-        for ilk in ilks:
-            self.dss.end.flow(ilk).transact(gas_price=self.gas_price)
+        self.transact_all([self.dss.end.flow(ilk) for ilk in ilks])
 
 
     def get_ilks(self) -> List[Ilk]:
         """ Use Ilks as saved in https://github.com/makerdao/pymaker/tree/master/config """
 
-        ilks = [self.dss.collaterals[key].ilk for key in self.dss.collaterals.keys()]
-        ilksFiltered = list(filter(lambda l: l.name != 'SAI', ilks))
-        ilks_with_debt = list(filter(lambda l: self.dss.vat.ilk(l.name).art > Wad(0), ilksFiltered))
+        ilks = [collateral.ilk for collateral in self.dss.collaterals.values() if collateral.ilk.name != 'SAI']
+
+        # Read the debt of every ilk concurrently, then filter in a single pass
+        ilk_states = self.reader.map(lambda ilk: self.dss.vat.ilk(ilk.name), ilks)
+        ilks_with_debt = [ilk for ilk, state in zip(ilks, ilk_states) if state.art > Wad(0)]
 
         ilkNames = [i.name for i in ilks_with_debt]
 
@@ -276,83 +396,186 @@ class CageKeeper:
 
         underwater_urns = []
 
-        for ilk in ilks:
+        # Every ilk's scan is recorded in the urn cache as reaching the same head
+        head = self.web3.eth.blockNumber if self.urn_cache else None
 
-            urn_history = UrnHistory(self.web3,
-                                     self.dss,
-                                     ilk,
-                                     self.deployment_block,
-                                     self.arguments.vulcanize_endpoint,
-                                     self.arguments.vulcanize_key)
+        # Each ilk's history is an independent, IO-bound log scan; run a few side by side, bounding peak memory
+        with ThreadPoolExecutor(max_workers=max(min(len(ilks), MAX_CONCURRENT_SCANS), 1)) as executor:
+            for underwater in executor.map(lambda ilk: self.scan_ilk(ilk, head), ilks):
+                underwater_urns.extend(underwater)
 
-            urns = urn_history.get_urns()
+        if self.urn_cache:
+            self.urn_cache.save()
 
-            self.logger.info(f'Collected {len(urns)} from {ilk}')
+        return underwater_urns
 
-            i = 0
-            for urn in urns.values():
-                urn.ilk = self.dss.vat.ilk(urn.ilk.name)
-                mat = self.dss.spotter.mat(urn.ilk)
-                usdDebt = Ray(urn.art) * urn.ilk.rate
-                usdCollateral = Ray(urn.ink) * urn.ilk.spot * mat
-                # Check if underwater ->  urn.art * ilk.rate > urn.ink * ilk.spot * spotter.mat[ilk]
-                if usdDebt > usdCollateral:
-                    underwater_urns.append(urn)
-                i += 1;
 
-                if i % 100 == 0:
-                    self.logger.info(f'Processed {i} urns of {ilk.name}')
+    def scan_ilk(self, ilk: Ilk, head: Optional[int] = None) -> List[Urn]:
+        """ Returns the underwater urns of the ilk """
+        urns = self.get_urns(ilk, head)
 
-        return underwater_urns
+        # rate, spot and mat are shared by every urn of the ilk; read them once per scan
+        ilk_data = self.dss.vat.ilk(ilk.name)
+        mat = self.dss.spotter.mat(ilk_data)
+
+        # Compare raw integers rather than building Ray objects per urn; scaling the debt side by a ray
+        # gives both sides 72 decimals:  art [wad] * rate [ray] * RAY  vs  ink [wad] * spot [ray] * mat [ray]
+        rate = ilk_data.rate.value * RAY
+        spot_mat = ilk_data.spot.value * mat.value
+
+        # Check if underwater ->  urn.art * ilk.rate > urn.ink * ilk.spot * spotter.mat[ilk]
+        underwater = [urn for urn in urns.values() if urn.art.value * rate > urn.ink.value * spot_mat]
+        for urn in underwater:
+            urn.ilk = ilk_data
+
+        self.logger.info(f'Processed {len(urns)} urns of {ilk.name}, {len(underwater)} underwater')
+
+        return underwater
+
+
+    def get_urns(self, ilk: Ilk, head: Optional[int] = None) -> Dict[Address, Urn]:
+        """ Returns every urn frobbed for the ilk, only scanning logs for blocks not already in the urn cache
+
+        With an urn cache, `head` is the block recorded as scanned; it is read from the node if not provided.
+        """
+        from_block = self.deployment_block
+        cached_addresses = []
+        if self.urn_cache:
+            to_block = self.urn_cache.to_block(ilk.name)
+            if to_block is not None:
+                from_block = max(to_block + 1, self.deployment_block)
+                cached_addresses = self.urn_cache.addresses(ilk.name)
+            if head is None:
+                head = self.web3.eth.blockNumber
+
+        urn_history = UrnHistory(self.web3,
+                                 self.dss,
+                                 ilk,
+                                 from_block,
+                                 self.arguments.vulcanize_endpoint,
+                                 self.arguments.vulcanize_key)
+
+        urns = urn_history.get_urns()
+
+        if self.urn_cache:
+            found = {urn.address.address for urn in urns.values()}
+            for address in cached_addresses:
+                if address not in found:
+                    urn = self.dss.vat.urn(ilk, Address(address))
+                    urns[urn.address] = urn
+
+            self.urn_cache.update(ilk.name, head, [urn.address.address for urn in urns.values()])
+
+        return urns
 
 
     def all_active_auctions(self) -> dict:
         """ Aggregates active auctions that meet criteria to be called after Cage """
+        # Each collateral has it's own flip contract; add auctions from each.
+        flippers = [collateral.flipper for collateral in self.dss.collaterals.values()]
+        contracts = flippers + [self.dss.flapper, self.dss.flopper]
+
+        # Read the bids of every auction contract in one pass rather than contract by contract
+        flip_bids = self.read_bids(contracts)
+        flap_bids = flip_bids.pop(-2)
+        flop_bids = flip_bids.pop(-1)
+
         flips = {}
-        for collateral in self.dss.collaterals.values():
-            # Each collateral has it's own flip contract; add auctions from each.
-            flips[collateral.ilk.name] = self.cage_active_auctions(collateral.flipper)
+        for collateral, bids in zip(self.dss.collaterals.values(), flip_bids):
+            flips[collateral.ilk.name] = self.cage_active_auctions(collateral.flipper, bids)
 
         return {
             "flips": flips,
-            "flaps": self.cage_active_auctions(self.dss.flapper),
-            "flops": self.cage_active_auctions(self.dss.flopper)
+            "flaps": self.cage_active_auctions(self.dss.flapper, flap_bids),
+            "flops": self.cage_active_auctions(self.dss.flopper, flop_bids)
         }
 
 
-    def cage_active_auctions(self, parentObj) -> List:
+    def read_bids(self, contracts: List) -> List[List]:
+        """ Returns every bid ever kicked on each auction contract, reading all of them concurrently """
+        counts = list(self.reader.map(lambda contract: contract.kicks(), contracts))
+
+        reads = [(contract, index) for contract, count in zip(contracts, counts) for index in range(1, count+1)]
+        bids = iter(self.reader.map(lambda read: read[0]._bids(read[1]), reads))
+
+        return [list(islice(bids, count)) for count in counts]
+
+
+    def cage_active_auctions(self, parentObj, bids: Optional[List] = None) -> List:
         """ Returns auctions that meet the requiremenets to be called by End.skip, Flap.yank, and Flop.yank """
         active_auctions = []
-        auction_count = parentObj.kicks()+1
+
+        if bids is None:
+            bids = self.read_bids([parentObj])[0]
 
         # flip auctions
         if isinstance(parentObj, Flipper):
-            for index in range(1, auction_count):
-                bid = parentObj._bids(index)
-                if bid.guy != Address("0x0000000000000000000000000000000000000000"):
+            for bid in bids:
+                if bid.guy != ZERO_ADDRESS:
                     if bid.bid < bid.tab:
                         active_auctions.append(bid)
-                index += 1
 
         # flap and flop auctions
         else:
-            for index in range(1, auction_count):
-                bid = parentObj._bids(index)
-                if bid.guy != Address("0x0000000000000000000000000000000000000000"):
+            for bid in bids:
+                if bid.guy != ZERO_ADDRESS:
                     active_auctions.append(bid)
-                index += 1
-
 
         return active_auctions
 
 
     def yank_auctions(self, flapBids: List, flopBids: List):
         """ Calls Flap.yank and Flop.yank on all auctions ids that meet the cage criteria """
-        for bid in flapBids:
-            self.dss.flapper.yank(bid.id).transact(gas_price=self.gas_price)
+        yanks = [self.dss.flapper.yank(bid.id) for bid in flapBids]
+        yanks += [self.dss.flopper.yank(bid.id) for bid in flopBids]
+
+        self.transact_all(yanks)
+
+
+    def transact_all(self, transacts: List[Transact]) -> list:
+        """ Submits every transaction before waiting on any receipt, so they are mined together instead of one per block
+
+        When a TxManager is configured, calls are bundled into `TxManager.execute` transactions of up to
+        `TX_MANAGER_BATCH_SIZE` calls each.  A bundle reverts as a whole (e.g. when another keeper already skimmed
+        one of its urns), so the calls of a failed bundle are retried as individual transactions.
+        """
+        if not transacts:
+            return []
+
+        if self.tx_manager is None:
+            return self.send_all(transacts)
+
+        batches = [transacts[i:i + TX_MANAGER_BATCH_SIZE] for i in range(0, len(transacts), TX_MANAGER_BATCH_SIZE)]
+        receipts = self.send_all([self.tx_manager.execute([], [transact.invocation() for transact in batch])
+                                  for batch in batches])
+
+        failed = [transact for batch, receipt in zip(batches, receipts)
+                  if receipt is None or not receipt.successful
+                  for transact in batch]
+        if failed:
+            self.logger.warning(f'{len(failed)} batched calls failed; retrying them individually')
+            receipts += self.send_all(failed)
 
-        for bid in flopBids:
-            self.dss.flopper.yank(bid.id).transact(gas_price=self.gas_price)
+        return receipts
+
+
+    def send_all(self, transacts: List[Transact]) -> list:
+        """ Sends all transactions at once and waits for their receipts
+
+        Each `transact_async` coroutine sends its transaction before first yielding to the event loop, so
+        transactions are sent in list order and pick up consecutive pending nonces.
+        """
+        # The gather has to be created on the loop which runs it; this may be a Lifecycle worker thread with no loop
+        async def send():
+            return await asyncio.gather(*[transact.transact_async(from_address=self.our_address,
+                                                                  gas_price=self.gas_price)
+                                          for transact in transacts])
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(send())
+        finally:
+            loop.close()
 
 
 if __name__ == '__main__':
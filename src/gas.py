@@ -0,0 +1,56 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from typing import Optional
+
+from pymaker.gas import GasPrice
+
+
+class CachedGasPrice(GasPrice):
+    """ Reuses prices from a gas strategy which queries the network, so a batch of transactions shares one lookup
+
+    Prices are cached per `time_elapsed` for `ttl` seconds.  Transactions sent together ask for the same
+    elapsed times as they are repriced, so only the first of them reaches the underlying strategy.
+    """
+
+    def __init__(self, strategy: GasPrice, ttl: int = 15):
+        assert isinstance(strategy, GasPrice)
+        assert isinstance(ttl, int)
+
+        self.strategy = strategy
+        self.ttl = ttl
+        self.prices = {}
+        self.lock = threading.Lock()
+
+    def get_gas_price(self, time_elapsed: int) -> Optional[int]:
+        assert isinstance(time_elapsed, int)
+
+        now = time.time()
+        with self.lock:
+            if time_elapsed in self.prices:
+                price, fetched = self.prices[time_elapsed]
+                if now - fetched < self.ttl:
+                    return price
+
+            price = self.strategy.get_gas_price(time_elapsed)
+
+            self.prices = {elapsed: entry for elapsed, entry in self.prices.items() if now - entry[1] < self.ttl}
+            self.prices[time_elapsed] = (price, now)
+
+            return price
@@ -0,0 +1,96 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+from typing import List, Optional
+
+from pymaker import Address
+
+
+class UrnCache:
+    """ Persists the addresses of urns frobbed for each ilk, so restarts only scan logs for blocks not yet seen
+
+    Urn balances are not cached; they change after the logs were scanned and are always read from the Vat.
+    """
+
+    logger = logging.getLogger('urn-cache')
+
+    # Only blocks this far behind the head are treated as final
+    confirmations = 12
+
+    def __init__(self, filename: str, vat: Address, deployment_block: int):
+        assert isinstance(filename, str)
+        assert isinstance(vat, Address)
+        assert isinstance(deployment_block, int)
+
+        self.filename = filename
+        self.vat = vat.address
+        self.deployment_block = deployment_block
+        self.ilks = self._load()
+
+    def _load(self) -> dict:
+        if not os.path.isfile(self.filename):
+            return {}
+
+        try:
+            with open(self.filename, "r") as file:
+                state = json.load(file)
+
+            if not isinstance(state, dict):
+                raise TypeError(f"expected an object, found {type(state).__name__}")
+
+            # A cache built for another Vat or deployment block would hide urns; start over
+            if state.get("vat") != self.vat or state.get("deployment_block") != self.deployment_block:
+                self.logger.info(f"Ignoring urn cache {self.filename} built for a different deployment")
+                return {}
+
+            ilks = state["ilks"]
+            if not isinstance(ilks, dict):
+                raise TypeError(f"expected ilks to be an object, found {type(ilks).__name__}")
+
+            for ilk in ilks.values():
+                if not isinstance(ilk["to_block"], int) or not isinstance(ilk["urns"], list):
+                    raise TypeError(f"malformed ilk entry {ilk}")
+
+            return ilks
+        except (OSError, ValueError, AttributeError, KeyError, TypeError) as e:
+            self.logger.warning(f"Ignoring unreadable urn cache {self.filename}: {e}")
+            return {}
+
+    def to_block(self, ilk_name: str) -> Optional[int]:
+        """ Returns the last block scanned for the ilk, or `None` if the ilk has not been scanned """
+        return self.ilks[ilk_name]["to_block"] if ilk_name in self.ilks else None
+
+    def addresses(self, ilk_name: str) -> List[str]:
+        return self.ilks[ilk_name]["urns"] if ilk_name in self.ilks else []
+
+    def update(self, ilk_name: str, head: int, addresses: List[str]):
+        """ Records urns found for the ilk by a scan up to `head`; the last unconfirmed blocks will be scanned again """
+        assert isinstance(head, int)
+
+        self.ilks[ilk_name] = {
+            "to_block": max(head - self.confirmations, self.deployment_block),
+            "urns": sorted(set(self.addresses(ilk_name)) | set(addresses))
+        }
+
+    def save(self):
+        temp_filename = f"{self.filename}.tmp"
+        with open(temp_filename, "w") as file:
+            json.dump({"vat": self.vat, "deployment_block": self.deployment_block, "ilks": self.ilks}, file)
+        os.replace(temp_filename, self.filename)
@@ -27,6 +27,7 @@ from pymaker.deployment import Deployment, DssDeployment
 from pymaker.dss import Vat, Vow, Cat, Jug, Pot
 from pymaker.shutdown import ShutdownModule, End
 from pymaker.keys import register_keys
+from pymaker.transactional import TxManager
 
 from src.cage_keeper import CageKeeper
 
@@ -112,6 +113,19 @@ def keeper(mcd: DssDeployment, keeper_address: Address) -> CageKeeper:
 
     return keeper
 
+@pytest.fixture(scope="session")
+def tx_manager_keeper(mcd: DssDeployment, keeper_address: Address) -> CageKeeper:
+    # Only the owner may call the TxManager, so deploy it from the keeper's address
+    mcd.web3.eth.defaultAccount = keeper_address.address
+    tx_manager = TxManager.deploy(mcd.web3)
+
+    keeper = CageKeeper(args=args(f"--eth-from {keeper_address} --network testnet --vat-deployment-block {1} "
+                                  f"--tx-manager {tx_manager.address}"), web3=mcd.web3)
+    assert isinstance(keeper, CageKeeper)
+    assert keeper.tx_manager.address == tx_manager.address
+
+    return keeper
+
 def args(arguments: str) -> list:
     return arguments.split()
 
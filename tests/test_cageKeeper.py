@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import json
 import pytest
 
 from datetime import datetime, timedelta, timezone
@@ -34,6 +35,7 @@ from pymaker.deployment import DssDeployment
 from pymaker.dss import Collateral, Ilk, Urn
 from pymaker.numeric import Wad, Ray, Rad
 from pymaker.shutdown import ShutdownModule, End
+from pymaker.token import DSToken
 
 from tests.test_auctions import create_debt, check_active_auctions, max_dart
 from tests.test_dss import mint_mkr, wrap_eth, frob, set_collateral_price
@@ -283,7 +285,7 @@ class TestCageKeeper:
         print_out("test_check_deployment")
         keeper.check_deployment()
 
-    def test_get_underwater_urns(self, mcd: DssDeployment, keeper: CageKeeper, guy_address: Address, our_address: Address):
+    def test_get_underwater_urns(self, mcd: DssDeployment, keeper: CageKeeper, guy_address: Address, our_address: Address, tmpdir):
         print_out("test_get_underwater_urns")
 
         previous_eth_price = open_underwater_urn(mcd, mcd.collaterals['ETH-A'], guy_address)
@@ -297,6 +299,20 @@ class TestCageKeeper:
         assert len(urns) == 1
         assert urns[0].address.address == guy_address.address
 
+        # A keeper with an urn cache finds the same urn, then finds it again from the cache alone
+        cached_keeper = CageKeeper(args=f"--eth-from {keeper.our_address} --network testnet --vat-deployment-block 1 "
+                                        f"--urn-cache-file {tmpdir.join('urns.json')}".split(), web3=mcd.web3)
+        cached_urns = cached_keeper.get_underwater_urns(ilks)
+        assert [urn.address for urn in cached_urns] == [guy_address]
+        assert tmpdir.join('urns.json').exists()
+
+        # Pretend every block has been scanned, so the urn can only come from the cached addresses
+        for ilk in ilks:
+            cached_keeper.urn_cache.ilks[ilk.name]["to_block"] = mcd.web3.eth.blockNumber
+        cached_urns = cached_keeper.get_underwater_urns(ilks)
+        assert [urn.address for urn in cached_urns] == [guy_address]
+        assert cached_urns[0].art == urns[0].art
+
         ## We've multiplied by a small Ray amount to counteract
         ## the residual dust (or lack thereof) in this step that causes
         ## create_flop_auction fail
@@ -357,6 +373,46 @@ class TestCageKeeper:
 
         pytest.global_auctions = auctions
 
+    def test_transact_all(self, mcd: DssDeployment, keeper: CageKeeper, our_address: Address, other_address: Address):
+        print_out("test_transact_all")
+        token = DSToken.deploy(mcd.web3, 'CAGE')
+
+        # Without a TxManager every call is its own transaction, sent from the keeper's address
+        receipts = keeper.transact_all([token.approve(our_address, Wad(1)), token.approve(other_address, Wad(2))])
+        assert len(receipts) == 2
+        assert all(receipt.successful for receipt in receipts)
+        assert token.allowance_of(keeper.our_address, our_address) == Wad(1)
+        assert token.allowance_of(keeper.our_address, other_address) == Wad(2)
+
+        # A call which fails does not prevent the others from being sent
+        receipts = keeper.transact_all([mcd.end.thaw(), token.approve(our_address, Wad(3))])
+        assert len(receipts) == 2
+        assert receipts[0] is None or not receipts[0].successful
+        assert receipts[1].successful
+        assert token.allowance_of(keeper.our_address, our_address) == Wad(3)
+
+    def test_tx_manager(self, mcd: DssDeployment, tx_manager_keeper: CageKeeper, our_address: Address, other_address: Address):
+        print_out("test_tx_manager")
+        keeper = tx_manager_keeper
+        token = DSToken.deploy(mcd.web3, 'CAGE')
+
+        # Calls which all succeed are bundled into a single TxManager transaction
+        receipts = keeper.transact_all([token.approve(our_address, Wad(1)), token.approve(other_address, Wad(2))])
+        assert len(receipts) == 1
+        assert receipts[0].successful
+        assert token.allowance_of(keeper.tx_manager.address, our_address) == Wad(1)
+        assert token.allowance_of(keeper.tx_manager.address, other_address) == Wad(2)
+
+        # End.thaw reverts before cage, so the bundle fails and each call is retried on its own
+        assert mcd.end.live() == 1
+        receipts = keeper.transact_all([token.approve(our_address, Wad(3)), mcd.end.thaw()])
+        assert len(receipts) == 3
+        assert receipts[0] is None or not receipts[0].successful
+        assert receipts[1].successful
+        assert receipts[2] is None or not receipts[2].successful
+        assert token.allowance_of(keeper.our_address, our_address) == Wad(3)
+        assert token.allowance_of(keeper.tx_manager.address, our_address) == Wad(1)
+
     def test_check_cage(self, mcd: DssDeployment, keeper: CageKeeper, our_address: Address, other_address: Address):
         print_out("test_check_cage")
         keeper.check_cage()
@@ -416,3 +472,80 @@ class TestCageKeeper:
 
         # Cage has been thawed (thaw() called)
         assert mcd.end.debt() != Rad(0)
+
+
+def state_keeper(mcd: DssDeployment, keeper_address: Address, state_file: str, extra_args: str = "") -> CageKeeper:
+    return CageKeeper(args=f"--eth-from {keeper_address} --network testnet --vat-deployment-block 1 "
+                           f"--state-file {state_file} {extra_args}".split(), web3=mcd.web3)
+
+
+def write_state(state_file, end: Address, confirmations: int, cageFacilitated: bool):
+    state_file.write(json.dumps({"end": end.address, "confirmations": confirmations, "cageFacilitated": cageFacilitated}))
+
+
+class TestCageKeeperState:
+
+    def test_save_and_restore(self, mcd: DssDeployment, keeper_address: Address, tmpdir):
+        state_file = tmpdir.join("state.json")
+        keeper = state_keeper(mcd, keeper_address, str(state_file))
+        assert keeper.confirmations == 0
+        assert keeper.cageFacilitated == False
+
+        keeper.confirmations = 5
+        keeper.save_state()
+        assert not tmpdir.join("state.json.tmp").exists()
+
+        restored = state_keeper(mcd, keeper_address, str(state_file))
+        assert restored.confirmations == 5
+        assert restored.cageFacilitated == False
+        assert restored._caged
+
+        restored.cageFacilitated = True
+        restored.save_state()
+        assert state_keeper(mcd, keeper_address, str(state_file)).cageFacilitated == True
+
+    def test_ignores_state_for_another_end(self, mcd: DssDeployment, keeper_address: Address, tmpdir):
+        state_file = tmpdir.join("state.json")
+        write_state(state_file, Address("0x1111111111111111111111111111111111111111"), 12, True)
+
+        keeper = state_keeper(mcd, keeper_address, str(state_file))
+        assert keeper.confirmations == 0
+        assert keeper.cageFacilitated == False
+
+    @pytest.mark.parametrize("contents", ['{"end": ', '[]', '{"confirmations": 3, "cageFacilitated": true}'])
+    def test_ignores_unreadable_state(self, mcd: DssDeployment, keeper_address: Address, tmpdir, contents: str):
+        state_file = tmpdir.join("state.json")
+        state_file.write(contents)
+
+        keeper = state_keeper(mcd, keeper_address, str(state_file))
+        assert keeper.confirmations == 0
+        assert keeper.cageFacilitated == False
+
+    def test_previous_cage_takes_precedence(self, mcd: DssDeployment, keeper_address: Address, tmpdir):
+        state_file = tmpdir.join("state.json")
+        write_state(state_file, mcd.end.address, 12, False)
+
+        keeper = state_keeper(mcd, keeper_address, str(state_file), "--previous-cage")
+        assert keeper.confirmations == 12
+        assert keeper.cageFacilitated == True
+
+    def test_failed_facilitation_is_not_saved(self, mcd: DssDeployment, keeper_address: Address, tmpdir, monkeypatch):
+        # The system was caged by TestCageKeeper
+        assert not mcd.end.live()
+        state_file = tmpdir.join("state.json")
+        write_state(state_file, mcd.end.address, 12, False)
+        keeper = state_keeper(mcd, keeper_address, str(state_file))
+
+        def failing_facilitation():
+            raise RuntimeError("facilitation failed")
+        monkeypatch.setattr(keeper, "facilitate_processing_period", failing_facilitation)
+
+        with pytest.raises(RuntimeError):
+            keeper.check_cage()
+        assert keeper.cageFacilitated == False
+        assert json.loads(state_file.read())["cageFacilitated"] == False
+
+        # The next block retries facilitation rather than moving on to thaw
+        with pytest.raises(RuntimeError):
+            keeper.check_cage()
+        assert keeper.cageFacilitated == False
@@ -0,0 +1,96 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from typing import Optional
+
+from pymaker.gas import GasPrice
+
+from src.gas import CachedGasPrice
+
+
+class CountingGasPrice(GasPrice):
+    """ Returns a new price on every lookup, recording which lookups reached it """
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.calls = []
+
+    def get_gas_price(self, time_elapsed: int) -> Optional[int]:
+        time.sleep(self.delay)
+        self.calls.append(time_elapsed)
+        return 1000 * len(self.calls) + time_elapsed
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+class TestCachedGasPrice:
+
+    def test_reuses_price_within_ttl(self, monkeypatch):
+        clock = FakeClock()
+        monkeypatch.setattr("src.gas.time", clock)
+        strategy = CountingGasPrice()
+        gas_price = CachedGasPrice(strategy, ttl=15)
+
+        assert gas_price.get_gas_price(0) == 1000
+        clock.now += 14
+        assert gas_price.get_gas_price(0) == 1000
+        assert strategy.calls == [0]
+
+    def test_refreshes_price_after_ttl(self, monkeypatch):
+        clock = FakeClock()
+        monkeypatch.setattr("src.gas.time", clock)
+        strategy = CountingGasPrice()
+        gas_price = CachedGasPrice(strategy, ttl=15)
+
+        assert gas_price.get_gas_price(0) == 1000
+        clock.now += 15
+        assert gas_price.get_gas_price(0) == 2000
+        assert strategy.calls == [0, 0]
+
+    def test_caches_each_time_elapsed_separately(self, monkeypatch):
+        clock = FakeClock()
+        monkeypatch.setattr("src.gas.time", clock)
+        strategy = CountingGasPrice()
+        gas_price = CachedGasPrice(strategy, ttl=15)
+
+        assert gas_price.get_gas_price(0) == 1000
+        assert gas_price.get_gas_price(30) == 2030
+        assert gas_price.get_gas_price(0) == 1000
+        assert gas_price.get_gas_price(30) == 2030
+        assert strategy.calls == [0, 30]
+
+    def test_concurrent_callers_share_one_lookup(self):
+        strategy = CountingGasPrice(delay=0.1)
+        gas_price = CachedGasPrice(strategy, ttl=15)
+
+        prices = []
+        threads = [threading.Thread(target=lambda: prices.append(gas_price.get_gas_price(0))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert prices == [1000] * 10
+        assert strategy.calls == [0]
@@ -0,0 +1,114 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from pymaker import Address
+
+from src.urn_cache import UrnCache
+
+
+vat = Address("0x1111111111111111111111111111111111111111")
+other_vat = Address("0x2222222222222222222222222222222222222222")
+
+urn_a = "0x000000000000000000000000000000000000000A"
+urn_b = "0x000000000000000000000000000000000000000B"
+urn_c = "0x000000000000000000000000000000000000000C"
+
+
+class TestUrnCache:
+
+    def test_empty_cache(self, tmpdir):
+        cache = UrnCache(str(tmpdir.join("urns.json")), vat, 10)
+
+        assert cache.to_block("ETH-A") is None
+        assert cache.addresses("ETH-A") == []
+
+    def test_to_block_lags_head_by_confirmations(self, tmpdir):
+        cache = UrnCache(str(tmpdir.join("urns.json")), vat, 10)
+
+        cache.update("ETH-A", 100, [urn_a])
+        assert cache.to_block("ETH-A") == 100 - UrnCache.confirmations
+
+        # Never reports a block before the deployment block
+        cache.update("ETH-B", 15, [urn_a])
+        assert cache.to_block("ETH-B") == 10
+
+    def test_update_merges_addresses(self, tmpdir):
+        cache = UrnCache(str(tmpdir.join("urns.json")), vat, 10)
+
+        cache.update("ETH-A", 100, [urn_a, urn_b])
+        cache.update("ETH-A", 200, [urn_b, urn_c])
+
+        assert cache.addresses("ETH-A") == [urn_a, urn_b, urn_c]
+        assert cache.to_block("ETH-A") == 200 - UrnCache.confirmations
+        assert cache.addresses("ETH-B") == []
+
+    def test_save_and_reload(self, tmpdir):
+        filename = str(tmpdir.join("urns.json"))
+        cache = UrnCache(filename, vat, 10)
+        cache.update("ETH-A", 100, [urn_a, urn_b])
+        cache.update("ETH-B", 50, [urn_c])
+        cache.save()
+
+        assert not tmpdir.join("urns.json.tmp").exists()
+
+        reloaded = UrnCache(filename, vat, 10)
+        assert reloaded.addresses("ETH-A") == [urn_a, urn_b]
+        assert reloaded.to_block("ETH-A") == 100 - UrnCache.confirmations
+        assert reloaded.addresses("ETH-B") == [urn_c]
+        assert reloaded.to_block("ETH-B") == 50 - UrnCache.confirmations
+
+    def test_ignores_cache_for_another_vat(self, tmpdir):
+        filename = str(tmpdir.join("urns.json"))
+        cache = UrnCache(filename, vat, 10)
+        cache.update("ETH-A", 100, [urn_a])
+        cache.save()
+
+        reloaded = UrnCache(filename, other_vat, 10)
+        assert reloaded.to_block("ETH-A") is None
+        assert reloaded.addresses("ETH-A") == []
+
+    def test_ignores_cache_for_another_deployment_block(self, tmpdir):
+        filename = str(tmpdir.join("urns.json"))
+        cache = UrnCache(filename, vat, 10)
+        cache.update("ETH-A", 100, [urn_a])
+        cache.save()
+
+        reloaded = UrnCache(filename, vat, 11)
+        assert reloaded.to_block("ETH-A") is None
+        assert reloaded.addresses("ETH-A") == []
+
+    @pytest.mark.parametrize("contents", [
+        '{"vat": ',
+        '[]',
+        '"urns"',
+        '42',
+        '{"vat": "0x1111111111111111111111111111111111111111", "deployment_block": 10}',
+        '{"vat": "0x1111111111111111111111111111111111111111", "deployment_block": 10, "ilks": []}',
+        '{"vat": "0x1111111111111111111111111111111111111111", "deployment_block": 10, "ilks": {"ETH-A": 5}}',
+        '{"vat": "0x1111111111111111111111111111111111111111", "deployment_block": 10, "ilks": {"ETH-A": {}}}',
+        '{"vat": "0x1111111111111111111111111111111111111111", "deployment_block": 10, '
+        '"ilks": {"ETH-A": {"to_block": "5", "urns": []}}}',
+    ])
+    def test_ignores_unreadable_cache(self, tmpdir, contents: str):
+        filename = tmpdir.join("urns.json")
+        filename.write(contents)
+
+        cache = UrnCache(str(filename), vat, 10)
+        assert cache.to_block("ETH-A") is None
+        assert cache.addresses("ETH-A") == []